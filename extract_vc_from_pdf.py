@@ -1,30 +1,127 @@
 import os
 import sys
-import json
+import argparse
 import csv
+import asyncio
+import gc
+import hashlib
+import re
+import signal
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
+import ahocorasick
+import numpy as np
+import orjson
 import pdfplumber
+import pymupdf
+import tiktoken
 from dotenv import load_dotenv
 from tqdm import tqdm
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+# Optional cheaper model tried first; unset sends everything to OPENAI_MODEL.
+OPENAI_SMALL_MODEL = os.getenv("OPENAI_SMALL_MODEL", "")
+# Number of failed sanity checks on the small model's row that triggers a retry on OPENAI_MODEL.
+ESCALATE_THRESHOLD = int(os.getenv("ESCALATE_THRESHOLD") or 1)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS") or os.cpu_count() or 1)
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY") or 8)
+PDF_BACKEND = os.getenv("PDF_BACKEND", "pymupdf").lower()
+# Echoing every streamed token costs a flushed write per token and interleaves
+# output from concurrent files, so it is opt-in.
+VERBOSE_STREAM = os.getenv("VERBOSE_STREAM", "0") == "1"
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD") or 0.92)
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+EXCERPT_TOKEN_BUDGET = int(os.getenv("EXCERPT_TOKEN_BUDGET") or 60000)
 
 if not OPENAI_API_KEY:
     print("[ERROR] OPENAI_API_KEY is required for LLM extraction.")
     sys.exit(1)
 
+if PDF_BACKEND not in ("pymupdf", "pdfplumber"):
+    print(f"[ERROR] Unknown PDF_BACKEND '{PDF_BACKEND}'; use 'pymupdf' or 'pdfplumber'.")
+    sys.exit(1)
+
 client_config = {"api_key": OPENAI_API_KEY}
 if OPENAI_BASE_URL:
     client_config["base_url"] = OPENAI_BASE_URL
-client = OpenAI(**client_config)
+client = AsyncOpenAI(**client_config)
 
 INPUT_DIR = "input/"
 OUTPUT_CSV = "results.csv"
+LLM_CACHE_DIR = "cache/llm/"
+PDF_TEXT_CACHE_DIR = "cache/pdf_text/"
+SEMANTIC_CACHE_DIR = os.path.join("cache/semantic/", OPENAI_EMBEDDING_MODEL.replace("/", "_"))
+# Characters of the top-scoring VC pages embedded per PDF; stays well inside
+# embedding-model input limits.
+SEMANTIC_CACHE_CHARS = 3000
 LINE = "-" * 60
+# Rows buffered between flushes of results.csv; closing the file flushes the rest.
+CSV_FLUSH_EVERY = 16
+BATCH_POLL_SECONDS = 60
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Pages handed to each worker process; amortizes re-opening the PDF per task.
+PAGES_PER_TASK = 12
+# Pages opened at a time when extracting in-process, to bound memory on large PDFs.
+SERIAL_PAGE_WINDOW = 50
+# Cover and offering-summary pages, always sent for 股票代码/公司简称.
+LEAD_PAGES = 3
+
+VC_KEYWORDS = [
+    "风险投资",
+    "创业投资",
+    "创投",
+    "风投",
+    "股权投资",
+    "产业投资",
+    "投资基金",
+    "私募基金",
+    "基金管理",
+    "投资管理",
+    "资本管理",
+    "投资中心",
+    "投资合伙",
+    "有限合伙",
+]
+
+ROLE_KEYWORDS = {
+    "董事": ["董事", "董事会"],
+    "监事": ["监事", "监事会"],
+    "高管": ["高级管理人员", "总经理", "财务负责人", "董事会秘书"],
+}
+
+
+def build_automaton(labelled_words) -> ahocorasick.Automaton:
+    automaton = ahocorasick.Automaton()
+    for word, label in labelled_words:
+        automaton.add_word(word, label)
+    automaton.make_automaton()
+    return automaton
+
+
+VC_LABEL = "风投"
+# One C-level pass per page finds every VC and role keyword, labelled by group.
+KEYWORD_AC = build_automaton(
+    [(k, VC_LABEL) for k in VC_KEYWORDS] + [(k, role) for role, kws in ROLE_KEYWORDS.items() for k in kws]
+)
+PERCENT_RE = re.compile(r"\d{1,3}(?:\.\d{1,4})?\s*[%％]")
+STOCK_CODE_RE = re.compile(r"\d{6}")
+FILE_CODE_RE = re.compile(r"(?<!\d)(\d{6})(?!\d)")
+# Opening ``` / ```json fence and closing ``` fence around the model's JSON.
+FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+NO_VC_VALUES = ("无", "（无）", "(无)")
+
+semantic_vectors = np.zeros((0, 0), dtype=np.float32)
+semantic_rows = []
+# Created on the main thread by start_pdf_pool().
+pdf_pool = None
 
 FIELDNAMES = [
     "股票代码",
@@ -40,20 +137,212 @@ FIELDNAMES = [
 ]
 
 
-def extract_pdf(path: str) -> str:
-    text = ""
+def _extract_page_range(path: str, start: int, count: int) -> list:
+    # Runs in a worker process (or in-process for small PDFs).
+    records = []
+    if PDF_BACKEND == "pymupdf":
+        with pymupdf.open(path) as doc:
+            for idx in range(start, min(start + count, doc.page_count)):
+                records.append(analyze_page(doc[idx].get_text("text")))
+        return records
+
+    # Only the requested pages are wrapped, and each is closed right after
+    # extraction so its parsed layout objects do not pile up.
+    with pdfplumber.open(path, pages=range(start + 1, start + count + 1)) as pdf:
+        for page in pdf.pages:
+            records.append(analyze_page(page.extract_text() or ""))
+            page.close()
+    # pdfplumber pages and documents reference each other; reclaim the cycles now.
+    gc.collect()
+    return records
+
+
+def count_pdf_pages(path: str) -> int:
+    if PDF_BACKEND == "pymupdf":
+        with pymupdf.open(path) as doc:
+            return doc.page_count
     with pdfplumber.open(path) as pdf:
-        total_pages = len(pdf.pages)
-        with tqdm(total=total_pages, desc=f"Extracting {os.path.basename(path)}", unit="page") as pbar:
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-                pbar.update(1)
-    return text
+        return len(pdf.pages)
+
+
+def _warm_pdf_worker() -> None:
+    if EXCERPT_TOKEN_BUDGET > 0:
+        get_encoding()
+
+
+def start_pdf_pool() -> None:
+    # One pool serves every PDF, so workers start (and load the tokenizer) once
+    # per run rather than once per file. Call this on the main thread before any
+    # other thread exists: under the fork start method the workers are forked on
+    # the first submit, and forking a multi-threaded process can deadlock.
+    global pdf_pool
+    if pdf_pool is not None or PDF_WORKERS <= 1:
+        return
+    # Forked workers inherit the loaded encoding; spawned ones find the BPE file
+    # in tiktoken's disk cache instead of each downloading it.
+    _warm_pdf_worker()
+    pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    pdf_pool.submit(_warm_pdf_worker).result()
+
+
+def shutdown_pdf_pool() -> None:
+    global pdf_pool
+    if pdf_pool is not None:
+        pdf_pool.shutdown(wait=True, cancel_futures=True)
+        pdf_pool = None
+
+
+def _iter_extracted_pages(path: str):
+    total_pages = count_pdf_pages(path)
+    desc = f"Extracting {os.path.basename(path)}"
+
+    # Without start_pdf_pool() (or with PDF_WORKERS=1) pages are read in-process.
+    if pdf_pool is None or total_pages <= PAGES_PER_TASK:
+        with tqdm(total=total_pages, desc=desc, unit="page") as pbar:
+            for start in range(0, total_pages, SERIAL_PAGE_WINDOW):
+                for record in _extract_page_range(path, start, SERIAL_PAGE_WINDOW):
+                    yield record
+                    pbar.update(1)
+        return
+
+    futures = [pdf_pool.submit(_extract_page_range, path, start, PAGES_PER_TASK) for start in range(0, total_pages, PAGES_PER_TASK)]
+    try:
+        with tqdm(total=total_pages, desc=desc, unit="page") as pbar:
+            # Collect blocks in submission order, so pages stay in order.
+            for future in futures:
+                block = future.result()
+                yield from block
+                pbar.update(len(block))
+    finally:
+        # If extraction fails part-way, drop blocks that have not started yet.
+        for future in futures:
+            future.cancel()
+
+
+def pdf_text_cache_path(path: str) -> str:
+    st = os.stat(path)
+    fingerprint = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{PDF_BACKEND}"
+    return os.path.join(PDF_TEXT_CACHE_DIR, hashlib.sha1(fingerprint.encode("utf-8")).hexdigest() + ".json")
+
 
+def read_page_cache(path: str) -> list:
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
 
-def build_prompt(text: str, filename: str) -> str:
-    return f"""
-你是资本市场研究助手。请阅读下方招股说明书全文，结合文件名信息，输出一个 JSON（不要 Markdown 代码块）。字段要求：
+
+def write_page_cache(path: str, pages: list) -> None:
+    # A JSON list keeps the page count and every page's text exactly, including
+    # blank pages and any form feeds the extractor emits.
+    os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(pages))
+    os.replace(tmp_path, path)
+
+
+def iter_pdf_pages(path: str):
+    # Yields (text, tokens, score) per page, in page order. Extracted text is
+    # kept under PDF_TEXT_CACHE_DIR so reruns skip PDF parsing.
+    cache_path = pdf_text_cache_path(path)
+    if os.path.exists(cache_path):
+        print(f"[CACHE] Reusing extracted text for '{os.path.basename(path)}'")
+        for text in read_page_cache(cache_path):
+            yield analyze_page(text)
+        return
+
+    pages = []
+    for record in _iter_extracted_pages(path):
+        pages.append(record[0])
+        yield record
+    write_page_cache(cache_path, pages)
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            # Custom deployment names are unknown to tiktoken; the count is only a budget.
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as exc:
+        # tiktoken downloads its BPE files on first use, which fails offline.
+        print(f"[TOKENS][WARN] Could not load tokenizer, estimating tokens by characters: {exc}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        # Chinese text runs at roughly one token per character or less, so the
+        # character count keeps the budget on the safe side.
+        return len(text)
+    return len(encoding.encode_ordinary(text))
+
+
+def score_page(page: str) -> int:
+    if not page or page.isspace():
+        # Scanned or blank pages extract to nothing.
+        return 0
+    hits = Counter(label for _, label in KEYWORD_AC.iter(page))
+    vc_hits = hits.pop(VC_LABEL, 0)
+    if not vc_hits:
+        # Without a VC mention, percentages are usually financial statements.
+        return 0
+    role_hits = sum(hits.values())
+    # A plain substring test is far cheaper than running the regex on pages without percentages.
+    percent_hits = len(PERCENT_RE.findall(page)) if "%" in page or "％" in page else 0
+    return vc_hits + role_hits + percent_hits
+
+
+def analyze_page(text: str) -> tuple:
+    # Called inside the extraction workers, so tokenizing and scoring run in
+    # parallel with extraction instead of on the main interpreter. Scores are
+    # always kept: the semantic cache embeds the top-scoring pages.
+    tokens = count_tokens(text) if EXCERPT_TOKEN_BUDGET > 0 else 0
+    return text, tokens, score_page(text)
+
+
+def select_excerpt(pages: list, tokens: list, scores: list, filename: str) -> list:
+    # Returns the chosen pages as (page_number, text, score), in document order.
+    if EXCERPT_TOKEN_BUDGET <= 0 or sum(tokens) <= EXCERPT_TOKEN_BUDGET:
+        return [(idx + 1, pages[idx], scores[idx]) for idx in range(len(pages))]
+
+    selected = set(range(min(LEAD_PAGES, len(pages))))
+    used = sum(tokens[idx] for idx in selected)
+    for idx in sorted(range(len(pages)), key=scores.__getitem__, reverse=True):
+        if not scores[idx]:
+            break
+        # Keep one page either side so tables and lists split across pages survive.
+        for j in (idx, idx - 1, idx + 1):
+            if 0 <= j < len(pages) and j not in selected and used + tokens[j] <= EXCERPT_TOKEN_BUDGET:
+                selected.add(j)
+                used += tokens[j]
+
+    print(f"[PDF] Sending {len(selected)}/{len(pages)} page(s), ~{used} tokens, for '{filename}'")
+    return [(idx + 1, pages[idx], scores[idx]) for idx in sorted(selected)]
+
+
+def build_excerpt(page_iter, filename: str) -> list:
+    # Pages are tokenized and scored as extraction proceeds, but the excerpt is
+    # only chosen once every page is in: the shareholder and 董监高 sections
+    # usually come well after early pages that already mention VC keywords.
+    pages, tokens, scores = [], [], []
+    for page, page_tokens, score in page_iter:
+        pages.append(page)
+        tokens.append(page_tokens)
+        scores.append(score)
+    return select_excerpt(pages, tokens, scores, filename)
+
+
+def extract_excerpt(path: str, filename: str) -> list:
+    with closing(iter_pdf_pages(path)) as page_iter:
+        return build_excerpt(page_iter, filename)
+
+
+# Static instructions go first and never change between files, so providers
+# that cache the longest common prompt prefix can reuse them on every call.
+SYSTEM_PROMPT = """你是资本市场研究助手。请阅读用户消息中的招股说明书正文（按页标注页码；可能是全文，也可能是风投、股东及董监高相关页面节选），结合文件名信息，输出一个 JSON（不要 Markdown 代码块）。字段要求：
 - "股票代码": 从正文或文件名提取，6位数字；无法确定则空字符串。
 - "公司简称": 从正文或文件名提取；无法确定则空字符串。
 - "最大风投机构名称": 只填风投/创投机构名称（非自然人、非产业方）。若无风投股东填""或"（无）"。
@@ -66,35 +355,152 @@ def build_prompt(text: str, filename: str) -> str:
 - "风投机构委派高管的类型": 同上；无则空。
 
 类型判别：仅金融/投资背景为"财务型"；仅技术/研发背景为"技术型"；兼具或多人各占一种为"复合型"。
-风投派遣董监高包括直接或通过关联方委派。只输出 JSON。
+风投派遣董监高包括直接或通过关联方委派。只输出 JSON。"""
+
 
-文件名: {filename}
-招股说明书全文:
+def build_prompt(excerpt: list, filename: str) -> str:
+    # The only place the selected pages are joined into one string.
+    text = "\n".join(f"[第{page_number}页]\n{page}" for page_number, page, _ in excerpt)
+    return f"""文件名: {filename}
+---
+招股说明书正文:
 {text}
 """
 
 
+def build_messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
 def parse_json_response(raw: str, filename: str) -> dict:
-    cleaned = raw.strip()
-    if cleaned.startswith("```json"):
-        cleaned = cleaned[len("```json"):].strip()
-        if cleaned.endswith("```"):
-            cleaned = cleaned[:-3].strip()
-    elif cleaned.startswith("```"):
-        cleaned = cleaned[3:].strip()
-        if cleaned.endswith("```"):
-            cleaned = cleaned[:-3].strip()
-
-    parsed = json.loads(cleaned)
+    cleaned = FENCE_RE.sub("", raw.strip())
+    parsed = orjson.loads(cleaned)
+    if not isinstance(parsed, dict):
+        raise ValueError(f"expected a JSON object, got {type(parsed).__name__}")
     print(f"[LLM] Parsed row for '{filename}': {parsed}")
     return parsed
 
 
-def ask_llm_non_stream(prompt: str, filename: str) -> dict:
-    print(f"[LLM] Fallback (non-stream) call for file='{filename}'")
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role": "user", "content": prompt}],
+def routed_models() -> tuple:
+    # The models ask_llm may route a file through.
+    return (OPENAI_MODEL, OPENAI_SMALL_MODEL) if OPENAI_SMALL_MODEL else (OPENAI_MODEL,)
+
+
+def llm_cache_key(prompt: str, models: tuple = None) -> str:
+    # Defaults to routed_models(); pass the exact models when a row comes from
+    # a single one.
+    payload = "\0".join((*(models or routed_models()), SYSTEM_PROMPT, prompt))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def semantic_fingerprint() -> str:
+    # Semantic entries answered under other models or instructions are stale,
+    # just as the exact cache key changes with them.
+    payload = "\0".join((*routed_models(), SYSTEM_PROMPT))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cache_get(key: str):
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError) as exc:
+        print(f"[CACHE][WARN] Ignoring unreadable cache entry '{path}': {exc}")
+        return None
+
+
+def cache_set(key: str, row: dict) -> None:
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(row))
+    os.replace(tmp_path, path)
+
+
+def semantic_cache_load() -> None:
+    global semantic_vectors, semantic_rows
+    vectors_path = os.path.join(SEMANTIC_CACHE_DIR, "vectors.f32")
+    entries_path = os.path.join(SEMANTIC_CACHE_DIR, "entries.jsonl")
+    if not os.path.exists(vectors_path):
+        return
+    entries = []
+    if os.path.exists(entries_path):
+        with open(entries_path, "rb") as f:
+            entries = [orjson.loads(line) for line in f if line.strip()]
+    dim = entries[0]["dim"] if entries else 0
+    vectors = np.fromfile(vectors_path, dtype=np.float32)
+    # A run interrupted between the two appends leaves one side longer; trim
+    # both so the next append lines up again.
+    n = min(len(vectors) // dim if dim else 0, len(entries))
+    if os.path.getsize(vectors_path) != n * dim * vectors.itemsize:
+        os.truncate(vectors_path, n * dim * vectors.itemsize)
+    if len(entries) != n:
+        with open(entries_path, "wb") as f:
+            f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in entries[:n]))
+    semantic_vectors = vectors[: n * dim].reshape(n, dim)
+    semantic_rows = entries[:n]
+    print(f"[CACHE] Loaded {n} semantic cache entr{'y' if n == 1 else 'ies'}")
+
+
+async def embed_text(excerpt: list):
+    # Embed the highest-scoring VC pages rather than the cover and declaration
+    # pages, which are near-identical boilerplate across prospectuses.
+    parts, size = [], 0
+    for _, page, score in sorted(excerpt, key=lambda item: item[2], reverse=True):
+        if not score or size >= SEMANTIC_CACHE_CHARS:
+            break
+        parts.append(page)
+        size += len(page)
+    if not parts:
+        return None
+    resp = await client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input="\n".join(parts)[:SEMANTIC_CACHE_CHARS])
+    vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+
+def semantic_cache_get(vec: np.ndarray, code: str):
+    if not semantic_rows or semantic_vectors.shape[1] != vec.shape[0]:
+        return None
+    sims = semantic_vectors @ vec
+    # Only reuse rows from files with the same stock code, e.g. revised drafts of
+    # one prospectus, so identity fields never cross between companies, and
+    # only rows answered under the current models and instructions.
+    fingerprint = semantic_fingerprint()
+    sims[[entry["code"] != code or entry.get("fingerprint") != fingerprint for entry in semantic_rows]] = -np.inf
+    best = int(sims.argmax())
+    if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    return semantic_rows[best]["row"], float(sims[best])
+
+
+def semantic_cache_add(vec: np.ndarray, code: str, row: dict) -> None:
+    global semantic_vectors
+    if semantic_rows and semantic_vectors.shape[1] != vec.shape[0]:
+        return
+    os.makedirs(SEMANTIC_CACHE_DIR, exist_ok=True)
+    entry = {"code": code, "fingerprint": semantic_fingerprint(), "dim": vec.shape[0], "row": row}
+    # Both files are append-only, so each new entry costs one vector and one
+    # line on disk rather than a rewrite of the whole store.
+    with open(os.path.join(SEMANTIC_CACHE_DIR, "vectors.f32"), "ab") as f:
+        vec.astype(np.float32).tofile(f)
+    with open(os.path.join(SEMANTIC_CACHE_DIR, "entries.jsonl"), "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+    semantic_vectors = np.vstack([semantic_vectors.reshape(-1, vec.shape[0]), vec])
+    semantic_rows.append(entry)
+
+
+async def ask_llm_non_stream(prompt: str, filename: str, model: str) -> dict:
+    print(f"[LLM] Fallback (non-stream) call to model='{model}' for file='{filename}'")
+    resp = await client.chat.completions.create(
+        model=model,
+        messages=build_messages(prompt),
         temperature=0,
     )
     raw = resp.choices[0].message.content or ""
@@ -102,40 +508,110 @@ def ask_llm_non_stream(prompt: str, filename: str) -> dict:
     return parse_json_response(raw, filename)
 
 
-def ask_llm_stream(text: str, filename: str) -> dict:
-    prompt = build_prompt(text, filename)
-    print(f"[LLM] Calling model='{OPENAI_MODEL}' for file='{filename}' (streaming)...")
+async def ask_llm_stream(prompt: str, filename: str, model: str) -> dict:
+    print(f"[LLM] Calling model='{model}' for file='{filename}' (streaming)...")
     chunks = []
     try:
-        stream = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role": "user", "content": prompt}],
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=build_messages(prompt),
             temperature=0,
             stream=True,
         )
 
-        for chunk in stream:
+        async for chunk in stream:
             delta = chunk.choices[0].delta
             content = delta.content or ""
             if content:
-                print(content, end="", flush=True)
+                if VERBOSE_STREAM:
+                    print(content, end="", flush=True)
                 chunks.append(content)
-        print()  # newline after stream
-        raw = "".join(chunks)
-        return parse_json_response(raw, filename)
+        if VERBOSE_STREAM:
+            print()  # newline after stream
     except Exception as exc:
         print(f"[LLM][WARN] Streaming failed for '{filename}': {exc}")
-        return ask_llm_non_stream(prompt, filename)
-
-
-def collect_results():
-    results = []
+        return await ask_llm_non_stream(prompt, filename, model)
+    # Parsed outside the try: a malformed answer would come back the same from
+    # a second, non-streaming call, so let the caller decide what to do.
+    return parse_json_response("".join(chunks), filename)
+
+
+def check_row(row: dict, excerpt: list, filename: str) -> list:
+    problems = []
+    missing = [k for k in FIELDNAMES if k not in row]
+    if missing:
+        problems.append(f"missing fields {missing}")
+    code = str(row.get("股票代码", "")).strip()
+    file_code = FILE_CODE_RE.search(filename)
+    if not code and not file_code:
+        pass  # nothing to check against; the prospectus may not state a code yet
+    elif not STOCK_CODE_RE.fullmatch(code):
+        problems.append(f"股票代码 '{code}' is not 6 digits")
+    elif file_code and file_code.group(1) != code:
+        problems.append(f"股票代码 '{code}' does not match filename code '{file_code.group(1)}'")
+    if not str(row.get("公司简称", "")).strip():
+        problems.append("公司简称 is empty")
+    vc_name = "".join(str(row.get("最大风投机构名称", "")).split())
+    # PDF text breaks long names across lines, so compare without whitespace,
+    # one page at a time rather than on a copy of the whole excerpt.
+    if vc_name and vc_name not in NO_VC_VALUES and not any(vc_name in "".join(page.split()) for _, page, _ in excerpt):
+        problems.append(f"最大风投机构名称 '{vc_name}' not found in the prospectus text")
+    return problems
+
+
+async def ask_llm(excerpt: list, filename: str) -> dict:
+    prompt = build_prompt(excerpt, filename)
+    # temperature=0, so a repeated (model, prompt) pair can reuse the stored row.
+    key = llm_cache_key(prompt)
+    cached = cache_get(key)
+    if cached is not None:
+        print(f"[CACHE] Reusing cached row for '{filename}'")
+        return cached
+
+    vec = None
+    file_code = FILE_CODE_RE.search(filename)
+    # Without a code in the filename a hit cannot be tied to the same company.
+    if SEMANTIC_CACHE and file_code:
+        try:
+            vec = await embed_text(excerpt)
+        except Exception as exc:
+            print(f"[CACHE][WARN] Embedding failed for '{filename}', skipping semantic cache: {exc}")
+        if vec is not None and (hit := semantic_cache_get(vec, file_code.group(1))) is not None:
+            row, similarity = hit
+            print(f"[CACHE] Reusing semantically similar row for '{filename}' (cosine={similarity:.3f})")
+            # Not written to the exact cache: the row was answered for another file.
+            return row
+
+    if OPENAI_SMALL_MODEL:
+        # Try the cheap model first; only pay for OPENAI_MODEL when its answer
+        # fails enough sanity checks against the filename and source text.
+        try:
+            row = await ask_llm_stream(prompt, filename, OPENAI_SMALL_MODEL)
+            problems = check_row(row, excerpt, filename)
+        except ValueError as exc:
+            # No row to keep, so escalate whatever ESCALATE_THRESHOLD says.
+            row, problems = None, [f"unparseable response ({exc})"]
+        if row is None or len(problems) >= ESCALATE_THRESHOLD:
+            print(f"[LLM] Escalating '{filename}' to model='{OPENAI_MODEL}': {'; '.join(problems)}")
+            row = await ask_llm_stream(prompt, filename, OPENAI_MODEL)
+    else:
+        row = await ask_llm_stream(prompt, filename, OPENAI_MODEL)
+
+    cache_set(key, row)
+    if vec is not None:
+        semantic_cache_add(vec, file_code.group(1), row)
+    return row
+
+
+def list_input_pdfs() -> list:
     files = [f for f in os.listdir(INPUT_DIR) if f.endswith(".pdf")]
-    total = len(files)
     print(LINE)
-    print(f"Found {total} PDF file(s) in '{INPUT_DIR}'")
+    print(f"Found {len(files)} PDF file(s) in '{INPUT_DIR}'")
     print(LINE)
+    return files
 
+
+def clear_output_csv() -> None:
     # Clear any existing results file before writing new rows
     if os.path.exists(OUTPUT_CSV):
         try:
@@ -146,41 +622,193 @@ def collect_results():
             print(f"[ERROR] Cannot clear '{OUTPUT_CSV}'. Close any program using it (e.g., Excel) and rerun.")
             sys.exit(1)
 
+
+def open_output_csv():
+    csv_file = open(OUTPUT_CSV, "w", newline="", encoding="utf-8-sig")
+    writer = csv.writer(csv_file)
+    writer.writerow(FIELDNAMES)
+    return csv_file, writer
+
+
+def csv_row(row: dict) -> tuple:
+    # Missing fields become empty cells and unexpected keys from the LLM are dropped.
+    return tuple(row.get(k, "") for k in FIELDNAMES)
+
+
+async def collect_results():
+    results = []
+    files = list_input_pdfs()
+    clear_output_csv()
+
+    if SEMANTIC_CACHE:
+        semantic_cache_load()
+
     writer = None
     csv_file = None
+    rows_since_flush = 0
+    loop = asyncio.get_running_loop()
+    llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+    csv_lock = asyncio.Lock()
+    start_pdf_pool()
+    pdf_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def process_one(fn: str) -> None:
+        nonlocal writer, csv_file, rows_since_flush
+        print(f"[PDF] Processing '{fn}'")
+        # Extraction already fans pages out to worker processes, so PDFs are
+        # extracted one at a time while earlier files wait on the LLM.
+        try:
+            excerpt = await loop.run_in_executor(pdf_executor, extract_excerpt, os.path.join(INPUT_DIR, fn), fn)
+            async with llm_sem:
+                row = await ask_llm(excerpt, fn)
+        except Exception as exc:
+            # One broken PDF or failed request must not abort the other files.
+            print(f"[ERROR] Skipping '{fn}': {exc!r}")
+            print(LINE)
+            return
+        results.append(row)
 
-    try:
-        for fn in files:
-            print(f"[PDF] Processing '{fn}'")
-            pdf_text = extract_pdf(os.path.join(INPUT_DIR, fn))
-            row = ask_llm_stream(pdf_text, fn)
-            results.append(row)
-
+        async with csv_lock:
             if writer is None:
-                csv_file = open(OUTPUT_CSV, "w", newline="", encoding="utf-8-sig")
-                writer = csv.DictWriter(csv_file, fieldnames=FIELDNAMES)
-                writer.writeheader()
+                csv_file, writer = open_output_csv()
 
-            writer.writerow(row)
-            if csv_file:
+            writer.writerow(csv_row(row))
+            rows_since_flush += 1
+            if rows_since_flush >= CSV_FLUSH_EVERY:
                 csv_file.flush()
+                rows_since_flush = 0
 
-            print(f"[DONE] Finished '{fn}'")
-            print(LINE)
+        print(f"[DONE] Finished '{fn}'")
+        print(LINE)
+
+    try:
+        await asyncio.gather(*(process_one(fn) for fn in files))
     finally:
+        pdf_executor.shutdown()
+        shutdown_pdf_pool()
         if csv_file:
             csv_file.close()
 
     return results
 
 
+async def run_batch(request_lines: list) -> dict:
+    data = b"\n".join(request_lines) + b"\n"
+    batch_input = await client.files.create(file=("batch_requests.jsonl", data), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"[BATCH] Submitted {len(request_lines)} request(s) as batch '{batch.id}'")
+
+    while batch.status not in BATCH_FINAL_STATUSES:
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        progress = f": {counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""
+        print(f"[BATCH] Status '{batch.status}'{progress}")
+    if batch.status != "completed":
+        print(f"[BATCH][WARN] Batch '{batch.id}' ended with status '{batch.status}'")
+
+    raws = {}
+    if batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"[BATCH][WARN] Request for '{result['custom_id']}' failed: {result.get('error') or response.get('body')}")
+                continue
+            raws[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"] or ""
+    return raws
+
+
+async def collect_results_batch():
+    files = list_input_pdfs()
+    clear_output_csv()
+
+    rows = {}
+    keys = {}
+    request_lines = []
+    try:
+        start_pdf_pool()
+        for fn in files:
+            print(f"[PDF] Processing '{fn}'")
+            try:
+                excerpt = extract_excerpt(os.path.join(INPUT_DIR, fn), fn)
+                prompt = build_prompt(excerpt, fn)
+            except Exception as exc:
+                # One broken PDF must not stop the rest from being submitted.
+                print(f"[ERROR] Skipping '{fn}': {exc!r}")
+                continue
+            # Batch requests always go to OPENAI_MODEL, whatever OPENAI_SMALL_MODEL is.
+            keys[fn] = llm_cache_key(prompt, (OPENAI_MODEL,))
+            cached = cache_get(keys[fn])
+            if cached is not None:
+                print(f"[CACHE] Reusing cached row for '{fn}'")
+                rows[fn] = cached
+                continue
+            request_lines.append(orjson.dumps({
+                "custom_id": fn,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": OPENAI_MODEL, "messages": build_messages(prompt), "temperature": 0},
+            }))
+    finally:
+        # Release the extraction workers before waiting on the batch.
+        shutdown_pdf_pool()
+
+    if request_lines:
+        raws = await run_batch(request_lines)
+        for fn in files:
+            if fn in rows or fn not in keys:
+                continue
+            if fn not in raws:
+                print(f"[BATCH][WARN] No result for '{fn}'; rerun to retry it")
+                continue
+            try:
+                rows[fn] = parse_json_response(raws[fn], fn)
+            except ValueError as exc:
+                print(f"[BATCH][WARN] Could not parse result for '{fn}': {exc}")
+                continue
+            cache_set(keys[fn], rows[fn])
+
+    results = [rows[fn] for fn in files if fn in rows]
+    if results:
+        csv_file, writer = open_output_csv()
+        with csv_file:
+            writer.writerows(csv_row(row) for row in results)
+    return results
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract VC information from IPO prospectus PDFs.")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="submit all PDFs through the OpenAI Batch API (lower cost, up to 24h turnaround) instead of streaming",
+    )
+    args = parser.parse_args()
+
+    def exit_on_sigterm(signum, frame):
+        # Turn SIGTERM into SystemExit so finally blocks flush and close results.csv.
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
     print(LINE)
-    print("VC IPO Extractor (LLM full-text, streaming)")
+    print(f"VC IPO Extractor (LLM, {'batch' if args.batch else 'streaming'})")
     print(f"Model: {OPENAI_MODEL}")
+    if OPENAI_SMALL_MODEL and not args.batch:
+        print(f"Small model: {OPENAI_SMALL_MODEL} (escalate after {ESCALATE_THRESHOLD} failed check(s))")
+    print(f"PDF backend: {PDF_BACKEND}")
+    print(f"Excerpt token budget: {EXCERPT_TOKEN_BUDGET or 'unlimited (full text)'}")
     if OPENAI_BASE_URL:
         print(f"Base URL: {OPENAI_BASE_URL}")
     print(LINE)
 
-    rows = collect_results()
+    rows = asyncio.run(collect_results_batch() if args.batch else collect_results())
     print(f"[CSV] Finished writing {len(rows)} row(s) to '{OUTPUT_CSV}'")